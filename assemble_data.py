@@ -2,6 +2,10 @@
 Assembles data from a dataset JSON and scraped TXT files into a TSV file to be parsed into a singular dataset by the model.
 This uses the data generated from scrape_data and a JSON downloaded from https://eightportions.com/datasets/Recipes/
 """
+import re
+import time
+import zlib
+import numpy as np
 from typing import List, Tuple, Dict
 from utils import clean_paragraphs
 
@@ -13,6 +17,25 @@ EXAMPLES_PER_CLASS = 60_000
 """The amount of examples per class to save. There are 199,030 ingredients with 83,465 unique values and 69,458 
 instructions with 61,580 unique values."""
 
+# -------- Near-Duplicate Parameters --------
+SIMILARITY_THRESHOLD = 0.7
+"""Paragraphs whose shingle sets have at least this Jaccard similarity to an earlier paragraph are removed as
+near-duplicates. "1 cup sugar" and "1 cup white sugar" are 0.8 similar; setting the threshold below that makes such
+pairs share a band, and so be compared, almost surely (see `_choose_bands`). The cost is that one changed shingle in
+a paragraph of six or more, like "1 cup chopped fresh parsley" and cilantro, is also a near-duplicate, as is a
+reordering of the same words."""
+WORD_PATTERN = re.compile(r'\d+(?:[/.]\d+)*|\w+')
+"""Matches the words of a paragraph for shingling. Amounts like 1/2 and 10.75 are kept as single words."""
+AMOUNT_PATTERN = re.compile(r'\d+(?:[/.]\d+)*(?:\s+\d+(?:[/.]\d+)*)*')
+"""Matches the amount a paragraph starts with, such as 1 1/2, which gets its own shingle"""
+NUM_PERMUTATIONS = 128
+"""Number of hash functions in each paragraph's MinHash signature"""
+LSH_RECALL = 0.9
+"""Minimum probability that paragraphs exactly at the similarity threshold are compared (see `_choose_bands`)"""
+ESTIMATE_MARGIN = 0.15
+"""How far below the threshold a pair's MinHash similarity estimate may be for the pair to still be checked exactly"""
+# ----------------
+
 
 def get_raw_json() -> str:
     """
@@ -41,26 +64,150 @@ def get_manual_data() -> Tuple[List[str], List[str]]:
         return list(set(ingredient_file.readlines())), list(set(instruction_file.readlines()))
 
 
+def _shingle(paragraph: str) -> List[str]:
+    """
+    :param paragraph: a cleaned paragraph
+    :return: the paragraph's shingles: its words, after lowercasing and removing punctuation, and a shingle for the
+    amount it starts with. Single words make an inserted modifier a small difference, so "1 cup white sugar" is a
+    near-duplicate of "1 cup sugar", while the amount shingle keeps "1/2 teaspoon salt" apart from "1 teaspoon salt".
+    """
+    paragraph = paragraph.lower()
+    amount = AMOUNT_PATTERN.match(paragraph)
+    words = WORD_PATTERN.findall(paragraph)
+    if amount:
+        words.append('#' + ' '.join(amount.group().split()))
+    return words or ['']
+
+
+def get_signatures(paragraphs: List[str]) -> np.ndarray:
+    """
+    Computes MinHash signatures of paragraphs: for each of `NUM_PERMUTATIONS` random hash functions, the minimum hash
+    of the paragraph's shingles. The share of matching signature values between two paragraphs estimates the Jaccard
+    similarity of their shingle sets.
+
+    :param paragraphs: a list of cleaned paragraphs
+    :return: A (len(paragraphs), NUM_PERMUTATIONS) uint32 signature array
+    """
+    return _get_signatures([_shingle(paragraph) for paragraph in paragraphs])
+
+
+def _get_signatures(shingle_lists: List[List[str]]) -> np.ndarray:
+    """
+    :param shingle_lists: the shingles of each paragraph, as returned by `_shingle`
+    :return: the paragraphs' MinHash signatures (see `get_signatures`)
+    """
+    shingle_hashes = np.fromiter((zlib.crc32(shingle.encode()) for shingles in shingle_lists for shingle in shingles),
+                                 dtype=np.uint64)
+    offsets = np.zeros(len(shingle_lists) + 1, dtype=np.int64)
+    np.cumsum([len(shingles) for shingles in shingle_lists], out=offsets[1:])
+
+    # Hash functions are multiply-shift: the top 32 bits of (a * x + b) in wrapping 64-bit arithmetic, with a odd.
+    # They need no modulo, which is slow on uint64 arrays and would dominate the runtime.
+    rng = np.random.default_rng(0)
+    multipliers = rng.integers(0, 1 << 63, NUM_PERMUTATIONS, dtype=np.uint64) * np.uint64(2) + np.uint64(1)
+    increments = rng.integers(0, 1 << 63, NUM_PERMUTATIONS, dtype=np.uint64)
+
+    # One hash function at a time, since a 1d reduceat is much faster than one over the rows of a 2d array
+    signatures = np.empty((len(shingle_lists), NUM_PERMUTATIONS), dtype=np.uint32)
+    for i in range(NUM_PERMUTATIONS):
+        permuted = ((shingle_hashes * multipliers[i] + increments[i]) >> np.uint64(32)).astype(np.uint32)
+        signatures[:, i] = np.minimum.reduceat(permuted, offsets[:-1])
+    return signatures
+
+
+def _choose_bands(threshold: float) -> Tuple[int, int]:
+    """
+    Chooses how to split signatures into bands for LSH. Paragraphs are candidate duplicates if any band of their
+    signatures is identical, which for a similarity s happens with probability 1 - (1 - s ^ rows) ^ bands. More bands
+    find more duplicates but also more false candidates, so this picks the fewest bands that make paragraphs exactly at
+    the threshold candidates with probability `LSH_RECALL`.
+
+    :param threshold: the similarity to aim the banding at
+    :return: A tuple of the number of bands and the number of signature rows in each band
+    """
+    for bands in range(1, NUM_PERMUTATIONS + 1):
+        rows = NUM_PERMUTATIONS // bands
+        if NUM_PERMUTATIONS % bands == 0 and 1 - (1 - threshold ** rows) ** bands >= LSH_RECALL:
+            return bands, rows
+    return NUM_PERMUTATIONS, 1
+
+
+def remove_near_duplicates(paragraphs: List[str], threshold: float = SIMILARITY_THRESHOLD) -> List[str]:
+    """
+    Removes paragraphs that are near-duplicates of earlier paragraphs in the list, using MinHash and LSH banding.
+    Each paragraph is only compared to the first paragraph it shares a band with, so this is approximate: it finds
+    nearly all pairs above the threshold without comparing every pair. Candidate pairs are checked by the exact
+    Jaccard similarity of their shingles, so the MinHash estimate only decides which pairs are checked.
+
+    :param paragraphs: a list of cleaned paragraphs
+    :param threshold: the Jaccard similarity above which a paragraph counts as a near-duplicate
+    :return: The paragraphs that are kept, in their original order
+    """
+    if not paragraphs:
+        return []
+    shingle_lists = [_shingle(paragraph) for paragraph in paragraphs]
+    signatures = _get_signatures(shingle_lists)
+    bands, rows = _choose_bands(threshold)
+    band_weights = np.random.default_rng(1).integers(1, 1 << 63, rows, dtype=np.uint64) | np.uint64(1)
+
+    keep = np.ones(len(paragraphs), dtype=bool)
+    checked = set()
+    for band in range(bands):
+        # Collapse each band into one key (wrapping uint64 arithmetic); key collisions are caught by the check below.
+        band_signatures = signatures[:, band * rows:(band + 1) * rows].astype(np.uint64)
+        keys = (band_signatures * band_weights).sum(axis=1, dtype=np.uint64)
+        _, first_index, bucket = np.unique(keys, return_index=True, return_inverse=True)
+        representative = first_index[bucket.ravel()]
+        candidates = np.flatnonzero((representative != np.arange(len(paragraphs))) & keep)
+        # Skip pairs whose estimate is far below the threshold, which are almost never near-duplicates
+        estimate = (signatures[candidates] == signatures[representative[candidates]]).mean(axis=1)
+        for candidate in candidates[estimate >= threshold - ESTIMATE_MARGIN]:
+            pair = (representative[candidate], candidate)
+            if pair in checked:
+                continue
+            checked.add(pair)
+            shingles, other_shingles = set(shingle_lists[candidate]), set(shingle_lists[pair[0]])
+            if len(shingles & other_shingles) >= threshold * len(shingles | other_shingles):
+                keep[candidate] = False
+
+    return [paragraph for paragraph, kept in zip(paragraphs, keep) if kept]
+
+
+def _deduplicate(paragraphs: List[str], name: str) -> List[str]:
+    """
+    Removes near-duplicates from a list of paragraphs, printing how many were removed and how long it took.
+
+    :param paragraphs: a list of cleaned paragraphs with no exact duplicates
+    :param name: the name of the class the paragraphs are examples of, for the printout
+    :return: The paragraphs that are kept, in their original order
+    """
+    start = time.perf_counter()
+    kept = remove_near_duplicates(paragraphs)
+    print(f'Removed {len(paragraphs) - len(kept)}/{len(paragraphs)} near-duplicate {name} examples '
+          f'in {time.perf_counter() - start:.2f}s')
+    return kept
+
+
 def get_data_lists() -> Tuple[List[str], List[str]]:
     ingredients, instructions = get_manual_data()
     # Trim spaces, remove blank/spacefill lines, remove duplocates
     # Cleanup is the same as actual inouts go through. Removing duplicates helps to remove junk that slipped
     # through the scraping and allows the model to become more general
-    ingredients, instructions = clean_paragraphs(ingredients), clean_paragraphs(instructions)
-    ingredients, instructions = set(ingredients), set(instructions)
-    recipes = get_json_dict()
-    i = 0
-    while len(instructions) < EXAMPLES_PER_CLASS or len(ingredients) < EXAMPLES_PER_CLASS:
-        item = recipes[i]
+    # dict.fromkeys removes exact duplicates like a set, but keeps the scraped data first.
+    ingredients = dict.fromkeys(clean_paragraphs(ingredients))
+    instructions = dict.fromkeys(clean_paragraphs(instructions))
+    # The whole JSON is read, since near-duplicate removal can leave a class short of EXAMPLES_PER_CLASS otherwise.
+    for item in get_json_dict():
         if item:  # JSON contains a few empty recipes for some reason. this check the item is not empty.
-            if len(instructions) < EXAMPLES_PER_CLASS:
-                instructions = instructions.union(clean_paragraphs(item['directions']))
-            if len(ingredients) < EXAMPLES_PER_CLASS:
-                ingredients = ingredients.union(clean_paragraphs(item['ingredients']))
-            print(f'{len(ingredients)}/{EXAMPLES_PER_CLASS}, {len(instructions)}/{EXAMPLES_PER_CLASS}')
-        i += 1
+            instructions.update(dict.fromkeys(clean_paragraphs(item['directions'])))
+            ingredients.update(dict.fromkeys(clean_paragraphs(item['ingredients'])))
 
-    return list(instructions)[:EXAMPLES_PER_CLASS], list(ingredients)[:EXAMPLES_PER_CLASS]
+    instructions = _deduplicate(list(instructions), 'instruction')
+    ingredients = _deduplicate(list(ingredients), 'ingredient')
+    # save_to_tsv cuts both classes to the smaller one, so a class short of EXAMPLES_PER_CLASS shrinks the dataset.
+    print(f'{min(len(ingredients), EXAMPLES_PER_CLASS)}/{EXAMPLES_PER_CLASS} ingredients, '
+          f'{min(len(instructions), EXAMPLES_PER_CLASS)}/{EXAMPLES_PER_CLASS} instructions after deduplication')
+    return instructions[:EXAMPLES_PER_CLASS], ingredients[:EXAMPLES_PER_CLASS]
 
 
 def save_to_tsv(instructions, ingredients):
@@ -74,8 +221,9 @@ def save_to_tsv(instructions, ingredients):
     dataset = []
 
 
-    # Combine between the lists, alternating
-    for i in range(EXAMPLES_PER_CLASS):
+    # Combine between the lists, alternating. Near-duplicate removal may leave fewer examples than EXAMPLES_PER_CLASS,
+    # in which case both classes are cut to the smaller one.
+    for i in range(min(len(ingredients), len(instructions))):
         dataset.append([ingredients[i], '1,0'])
         dataset.append([instructions[i], '0,1'])
 
@@ -1,5 +1,9 @@
 from tensorflow.python.keras.models import Sequential
 
+import os
+import time
+import shutil
+import tracemalloc
 import utils as utils
 import tensorflow as tf
 import numpy as np
@@ -17,6 +21,8 @@ MODEL_PATH = 'savefiles/Classifier'
 """Path to save the model to and load it from"""
 TOKENIZER_PATH = 'savefiles/classifier_tokenizer.json'
 """Path to save the tokenizer to and load it from"""
+SHARDS_PATH = 'savefiles/shards'
+"""Directory to save the tokenized dataset to, one subdirectory per version of the tokenizer and data files"""
 # ----------------
 
 
@@ -58,7 +64,7 @@ def unpack_tsv() -> Tuple[List[str], List[List[int]]]:
     raw_data = []
     labels = []
 
-    with open(TSV_PATH) as tsvfile, open('datafiles/neither.txt') as neitherfile:
+    with open(TSV_PATH) as tsvfile, open(DATAFILES[2]) as neitherfile:
         for i, item in enumerate(tsvfile.readlines()):
             cells = item.split('\t')
             raw_data.append(cells[0])
@@ -73,20 +79,68 @@ def unpack_tsv() -> Tuple[List[str], List[List[int]]]:
         return raw_data, labels
 
 
-def get_data() -> Tuple[Tuple[np.ndarray, np.array], Tuple[np.ndarray, np.array]]:
+def get_shard(fit_tokenizer: bool = False) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
     """
-    :return: A tuple of the training and testing datasets.
+    Loads the tokenized dataset from `SHARDS_PATH`. The dataset is only tokenized and written there when no shard
+    exists for the current tokenizer and data files, and shards of older versions are then deleted.
+
+    :param fit_tokenizer: fit and save a new tokenizer to the training data first, as when retraining the model.
+    Otherwise, the saved tokenizer is used, so that the data matches the saved model.
+    :return: The shard's flat token array, offsets array and labels array (see `utils.write_shard`)
+    :raises FileNotFoundError: if no tokenizer is saved and `fit_tokenizer` is not set
+    """
+    raw_data = None
+    if fit_tokenizer:
+        raw_data, labels = unpack_tsv()
+        generate_tokenizer(raw_data[:TRAINING_SIZE])
+    elif not os.path.exists(TOKENIZER_PATH):
+        raise FileNotFoundError(f"No tokenizer saved at '{TOKENIZER_PATH}'. Train the model to generate one.")
+
+    version = utils.fingerprint(TOKENIZER_PATH, TSV_PATH, DATAFILES[2])
+    shard_path = os.path.join(SHARDS_PATH, version)
+    if not os.path.exists(shard_path):
+        if raw_data is None:
+            raw_data, labels = unpack_tsv()
+        utils.write_shard(get_tokenizer().texts_to_sequences(raw_data), labels, shard_path)
+        for stale in os.listdir(SHARDS_PATH):
+            if stale != version:
+                shutil.rmtree(os.path.join(SHARDS_PATH, stale), ignore_errors=True)
+    return utils.load_shard(shard_path)
+
+
+def get_data(fit_tokenizer: bool = False) -> Tuple[utils.ShardSequence, utils.ShardSequence]:
     """
-    raw_data, labels = unpack_tsv()
+    :param fit_tokenizer: fit and save a new tokenizer to the training data first, as when retraining the model.
+    :return: A tuple of the training and testing datasets, as batch sequences that keras models can be fit to and
+    evaluated on.
+    """
+    shard = get_shard(fit_tokenizer)
+    example_count = len(shard[1]) - 1
+    # Like slicing at TRAINING_SIZE, a dataset smaller than that is all used for training.
+    training_size = min(TRAINING_SIZE, example_count)
+    training_data = utils.ShardSequence(shard, np.arange(training_size), INPUT_LENGTH, shuffle=True)
+    testing_data = utils.ShardSequence(shard, np.arange(training_size, example_count), INPUT_LENGTH)
+    return training_data, testing_data
 
-    tokenizer = utils.generate_tokenizer(VOCABULARY_SIZE, raw_data[:TRAINING_SIZE], TOKENIZER_PATH)
 
-    processed_data = utils.preprocess_text(raw_data, tokenizer, INPUT_LENGTH)
-    processed_labels = utils.preprocess_labels(labels)
+def benchmark_data():
+    """
+    Prints the load time and peak memory use of the tokenized dataset, as loaded from its shard and as built by
+    tokenizing and padding the dataset TSV in memory.
+    """
+    def load_dense():
+        raw_data, labels = unpack_tsv()
+        return utils.preprocess_text(raw_data, get_tokenizer(), INPUT_LENGTH), utils.preprocess_labels(labels)
 
-    training_data, training_labels = processed_data[:TRAINING_SIZE], processed_labels[:TRAINING_SIZE]
-    testing_data, testing_labels = processed_data[TRAINING_SIZE:], processed_labels[TRAINING_SIZE:]
-    return (training_data, training_labels), (testing_data, testing_labels)
+    get_shard()  # Make sure the shard exists, so only loading it is measured
+    for name, load in [('Dense', load_dense), ('Shard', get_shard)]:
+        tracemalloc.start()
+        start = time.perf_counter()
+        load()
+        elapsed = time.perf_counter() - start
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        print(f'{name}: loaded in {elapsed:.2f}s, peak memory {peak / 2 ** 20:.1f} MiB')
 
 
 def generate_tokenizer(texts_to_fit: List[str]) -> Tokenizer:
@@ -108,14 +162,19 @@ def get_tokenizer() -> Tokenizer:
     return utils.load_tokenizer(TOKENIZER_PATH)
 
 
-def predict(texts: List[str]) -> List[List[float]]:
+def predict(texts: List[str], model: Sequential = None, tokenizer: Tokenizer = None) -> List[List[float]]:
     """
     Predicts the classes of textual inputs: ingredient, instruction, and junk.
     :param texts: A list of textual inputs to classify
+    :param model: the model to predict with, if already loaded. Otherwise, it is loaded from `MODEL_PATH`
+    :param tokenizer: the tokenizer to preprocess with, if already loaded. Otherwise, it is loaded from `TOKENIZER_PATH`
     :return:
     """
-    model = get_model()
-    processed_data = utils.preprocess_text(texts, get_tokenizer(), INPUT_LENGTH)
+    if model is None:
+        model = get_model()
+    if tokenizer is None:
+        tokenizer = get_tokenizer()
+    processed_data = utils.preprocess_text(texts, tokenizer, INPUT_LENGTH)
     return model.predict(processed_data)
 # ================
 
@@ -171,8 +230,8 @@ def train_model():
     Trains the model based on the TSV file generated by assemble_data and the neither.txt file generated by scrape_data.
     """
     model = generate_model()
-    training_dataset, testing_dataset = get_data()
-    model.fit(*training_dataset, validation_data=testing_dataset, epochs=MAX_EPOCHS, callbacks=CALLBACKS)
+    training_dataset, testing_dataset = get_data(fit_tokenizer=True)
+    model.fit(training_dataset, validation_data=testing_dataset, epochs=MAX_EPOCHS, callbacks=CALLBACKS)
 # ================
 
 
@@ -182,8 +241,8 @@ def test_on_json():
     Evaluates the model on the test data from JSON dataset from kraggle
     """
     model = get_model()
-    _, (test_data, test_labels) = get_data()
-    model.evaluate(test_data, np.array(test_labels))
+    _, testing_dataset = get_data()
+    model.evaluate(testing_dataset)
 
 
 def test_on_scraped():
@@ -193,6 +252,8 @@ def test_on_scraped():
     # DATAFILES = [ingredients,instructions, junk]
     # Labels matching data files.
     labels = [[1, 0], [0, 1], [0, 0]]
+    model = get_model()
+    tokenizer = get_tokenizer()
     # For each file
     for filename, label in zip(DATAFILES, labels):
         # Get the file data
@@ -200,7 +261,7 @@ def test_on_scraped():
             test_data = datafile.readlines()
         # Generate valid datasets from it
         test_labels = np.array([label for _ in test_data])
-        test_data = utils.preprocess_text(test_data, get_tokenizer(), INPUT_LENGTH)
+        test_data = utils.preprocess_text(test_data, tokenizer, INPUT_LENGTH)
         # Show model evaluations and average prediction
         print(filename)
         model.evaluate(test_data, test_labels)
@@ -213,7 +274,6 @@ def test_on_scraped():
 if __name__ == '__main__':
     train_model()
 
-    model = load_model(MODEL_PATH)
     test_on_json()
     test_on_scraped()
 # ================
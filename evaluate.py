@@ -0,0 +1,205 @@
+"""
+Evaluates the classifier on its labelled data and calibrates the confidence thresholds main.py classifies by.
+
+The model is run once over the scraped data files and the held-out rows of the dataset TSV, and its scores are cached
+as NumPy arrays under the savefiles directory. The cache is keyed by a fingerprint of the model, tokenizer and data,
+so it is only rebuilt when they change.
+
+Thresholds are then swept over a grid, with every (ingredient, instruction) threshold pair evaluated at once: scores are
+bucketed by grid position, and the counts of every confusion matrix on the grid are read off cumulative sums of the
+buckets. The best pair by macro F1 on the held-out dataset rows is written to `main.THRESHOLDS_PATH`, which
+`main.classify` reads. The scraped lines are mostly in the training split, so their results are printed as a diagnostic
+but do not pick the thresholds.
+"""
+import os
+import json
+import numpy as np
+import classifier
+import utils
+from typing import Dict, List, Tuple
+from utils import DATAFILES
+from main import THRESHOLDS_PATH
+
+# -------- Evaluation Parameters --------
+SCORES_PATH = 'savefiles/scores.npz'
+"""Path to cache model scores on the labelled data in"""
+CURVES_PATH = 'savefiles/threshold_curves.npz'
+"""Path to save the precision/recall/F1 curves of the threshold sweep to"""
+THRESHOLD_STEPS = 201
+"""Number of values in the threshold grid, spaced evenly over [0, 1] for each class"""
+CLASS_NAMES = ['ingredient', 'instruction', 'neither']
+"""Class names by their integer classification in main.classify"""
+SOURCES = ['scraped', 'dataset']
+"""Names of the data sources, by the source index cached with each score"""
+CALIBRATION_SOURCE = 'dataset'
+"""The data source thresholds are chosen on. Only the dataset rows held out of training are unbiased by it."""
+# ----------------
+
+
+# ======== SCORING ========
+def get_scraped_data() -> Tuple[List[str], np.ndarray]:
+    """
+    :return: A tuple of every line of the scraped data files and their integer classes
+    """
+    texts, classes = [], []
+    # DATAFILES = [ingredients, instructions, junk], matching classes 0, 1 and 2
+    for class_index, filename in enumerate(DATAFILES):
+        with open(filename) as datafile:
+            lines = datafile.readlines()
+        texts += lines
+        classes += [class_index] * len(lines)
+    return texts, np.array(classes, dtype=np.int8)
+
+
+def _model_fingerprint() -> str:
+    """
+    :return: a digest of the saved model, tokenizer and labelled data, which the cached scores are valid for
+    """
+    return utils.fingerprint(classifier.MODEL_PATH, classifier.TOKENIZER_PATH, classifier.TSV_PATH, *DATAFILES)
+
+
+def score_data(force: bool = False) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Scores the labelled data with the saved model, or loads the scores cached at `SCORES_PATH` if they were computed
+    by the current model and data. The labelled data is every line of the scraped data files, and the rows of the
+    dataset that are not used in training.
+
+    :param force: recompute the scores even if a valid cache exists
+    :return: A tuple of the (N, 2) array of model scores, the N integer classes and the N source indices
+    """
+    version = _model_fingerprint()
+    if not force and os.path.exists(SCORES_PATH):
+        with np.load(SCORES_PATH) as cache:
+            if str(cache['version']) == version:
+                return cache['scores'], cache['classes'], cache['sources']
+
+    model = classifier.get_model()
+    texts, scraped_classes = get_scraped_data()
+    processed_data = utils.preprocess_text(texts, classifier.get_tokenizer(), classifier.INPUT_LENGTH)
+    scraped_scores = model.predict(processed_data)
+
+    _, testing_dataset = classifier.get_data()
+    dataset_scores = model.predict(testing_dataset)
+    dataset_labels = testing_dataset.labels[testing_dataset.indices]
+    # Label vectors [1, 0], [0, 1] and [0, 0] map to classes 0, 1 and 2
+    dataset_classes = np.where(dataset_labels[:, 0], 0, np.where(dataset_labels[:, 1], 1, 2)).astype(np.int8)
+
+    scores = np.concatenate([scraped_scores, dataset_scores]).astype(np.float32)
+    classes = np.concatenate([scraped_classes, dataset_classes])
+    sources = np.repeat(np.arange(len(SOURCES), dtype=np.int8), [len(scraped_classes), len(dataset_classes)])
+
+    np.savez(SCORES_PATH, scores=scores, classes=classes, sources=sources, version=version)
+    return scores, classes, sources
+# ================
+
+
+# ======== THRESHOLD SWEEP ========
+def get_threshold_grid() -> np.ndarray:
+    """
+    :return: the `THRESHOLD_STEPS` threshold values to sweep for each class
+    """
+    return np.linspace(0, 1, THRESHOLD_STEPS)
+
+
+def sweep_confusion(scores: np.ndarray, classes: np.ndarray, grid: np.ndarray) -> np.ndarray:
+    """
+    Computes the confusion matrix of `main.classify`'s decision rule for every pair of thresholds on the grid:
+    a paragraph is an instruction if its instruction score passes the instruction threshold, otherwise an ingredient
+    if its ingredient score passes the ingredient threshold, and otherwise neither.
+
+    :param scores: (N, 2) model scores, ingredient score first
+    :param classes: N true integer classes
+    :param grid: the G threshold values to sweep, in increasing order
+    :return: A (G, G, 3, 3) integer array, indexed by ingredient threshold, instruction threshold, true class and
+    predicted class
+    """
+    steps = len(grid)
+    # A score passes threshold k exactly when k is below the score's bucket: the number of thresholds under it.
+    ingredient_bucket = np.searchsorted(grid, scores[:, 0], side='left')
+    instruction_bucket = np.searchsorted(grid, scores[:, 1], side='left')
+    # counts[c, i, j] is the number of class c paragraphs in instruction bucket i and ingredient bucket j
+    flat_index = (classes.astype(np.int64) * (steps + 1) + instruction_bucket) * (steps + 1) + ingredient_bucket
+    counts = np.bincount(flat_index, minlength=3 * (steps + 1) ** 2).reshape(3, steps + 1, steps + 1)
+
+    # below[c, i, j]: class c paragraphs with instruction bucket <= i and ingredient bucket <= j
+    below = counts.cumsum(axis=1).cumsum(axis=2)
+    totals = below[:, -1, -1]
+    not_instruction = below[:, :steps, -1]  # Instruction score fails threshold i, shape (3, G)
+    # Fails instruction threshold i and passes ingredient threshold j, shape (3, G, G)
+    ingredient = not_instruction[:, :, np.newaxis] - below[:, :steps, :steps]
+    instruction = totals[:, np.newaxis] - not_instruction
+
+    confusion = np.empty((steps, steps, 3, 3), dtype=np.int64)
+    # Axes of the sweep arrays are (class, instruction threshold, ingredient threshold); move classes last.
+    confusion[:, :, :, 0] = ingredient.transpose(2, 1, 0)
+    confusion[:, :, :, 1] = np.broadcast_to(instruction.T, (steps, steps, 3))
+    confusion[:, :, :, 2] = not_instruction.T[np.newaxis] - confusion[:, :, :, 0]
+    return confusion
+
+
+def get_curves(confusion: np.ndarray) -> Dict[str, np.ndarray]:
+    """
+    :param confusion: confusion matrices as returned by `sweep_confusion`
+    :return: A dictionary of (..., 3) per-class precision, recall and F1 arrays over the sweep, and the macro F1
+    """
+    true_positives = np.diagonal(confusion, axis1=-2, axis2=-1).astype(np.float64)
+    predicted = confusion.sum(axis=-2)
+    actual = confusion.sum(axis=-1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        precision = np.nan_to_num(true_positives / predicted)
+        recall = np.nan_to_num(true_positives / actual)
+        f1 = np.nan_to_num(2 * precision * recall / (precision + recall))
+    return {'precision': precision, 'recall': recall, 'f1': f1, 'macro_f1': f1.mean(axis=-1)}
+
+
+def confusion_at(scores: np.ndarray, classes: np.ndarray, ingredient_threshold: float,
+                 instruction_threshold: float) -> np.ndarray:
+    """
+    :param scores: (N, 2) model scores, ingredient score first
+    :param classes: N true integer classes
+    :param ingredient_threshold: the ingredient confidence threshold to classify by
+    :param instruction_threshold: the instruction confidence threshold to classify by
+    :return: the (3, 3) confusion matrix, indexed by true class and predicted class
+    """
+    predictions = np.where(scores[:, 1] > instruction_threshold, 1, np.where(scores[:, 0] > ingredient_threshold, 0, 2))
+    return np.bincount(classes * 3 + predictions, minlength=9).reshape(3, 3)
+
+
+def calibrate(force: bool = False) -> Tuple[float, float]:
+    """
+    Sweeps the threshold grid over the cached scores of `CALIBRATION_SOURCE`, saves the curves to `CURVES_PATH` and
+    the thresholds with the best macro F1 to `THRESHOLDS_PATH`, and prints the results at those thresholds for each
+    data source.
+
+    :param force: rescore the data even if the cached scores are valid
+    :return: the chosen `(ingredient, instruction)` thresholds
+    """
+    scores, classes, sources = score_data(force)
+    held_out = sources == SOURCES.index(CALIBRATION_SOURCE)
+    grid = get_threshold_grid()
+    confusion = sweep_confusion(scores[held_out], classes[held_out], grid)
+    curves = get_curves(confusion)
+    np.savez(CURVES_PATH, thresholds=grid, **curves)
+
+    ingredient_index, instruction_index = np.unravel_index(np.argmax(curves['macro_f1']), curves['macro_f1'].shape)
+    ingredient_threshold, instruction_threshold = float(grid[ingredient_index]), float(grid[instruction_index])
+    with open(THRESHOLDS_PATH, 'w+') as thresholds_file:
+        json.dump({'ingredient': ingredient_threshold, 'instruction': instruction_threshold}, thresholds_file)
+
+    print(f'Thresholds: ingredient {ingredient_threshold:.3f}, instruction {instruction_threshold:.3f}')
+    for name, precision, recall, f1 in zip(CLASS_NAMES, *(curves[key][ingredient_index, instruction_index]
+                                                          for key in ['precision', 'recall', 'f1'])):
+        print(f'{name}: precision {precision:.3f}, recall {recall:.3f}, F1 {f1:.3f}')
+    for source_index, source in enumerate(SOURCES):
+        in_source = sources == source_index
+        print(source if source == CALIBRATION_SOURCE else f'{source} (diagnostic only, mostly training data)')
+        print(confusion_at(scores[in_source], classes[in_source], ingredient_threshold, instruction_threshold))
+
+    return ingredient_threshold, instruction_threshold
+# ================
+
+
+# ======== RUNNING SCRIPT ========
+if __name__ == '__main__':
+    calibrate()
+# ================
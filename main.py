@@ -1,13 +1,68 @@
+import os
+import re
+import json
+import math
+import time
+import functools
+import threading
+import urllib3
 import requests
 import classifier
 from bs4 import BeautifulSoup
-from typing import List
-from utils import clean_paragraphs
+from typing import List, Tuple, Dict, NamedTuple, Optional
+from utils import clean_paragraphs, Deadline
 
 CONFIDENCE_THRESHOLD_INGREDIENT = 0.9
 """Minimum model confidence in ingredient classification to go into JSON"""
 CONFIDENCE_THRESHOLD_INSTRUCTION = 0.68
 """Minimum model confidence in instruction classification to go into JSON"""
+THRESHOLDS_PATH = 'savefiles/thresholds.json'
+"""Path of the thresholds calibrated by evaluate.py. If it exists, it overrides the two defaults above."""
+
+REQUEST_DEADLINE = 10.0
+"""Seconds get_recipe_json has to extract a recipe in. Stages out of time degrade the result rather than fail."""
+STAGE_SHARES = {'fetch': 0.5, 'parse': 0.2, 'classify': 0.3}
+"""Share of the deadline each extraction stage gets. Time a stage does not use is split between the stages after it."""
+FETCH_CHUNK_SIZE = 1024
+"""Number of bytes to read from a webpage at a time"""
+FETCH_TIMED_OUT = 'fetch ran out of time'
+"""Reason `fetch_html` gives for a download cut short by its budget"""
+FETCH_DROPPED = 'fetch lost the connection'
+"""Reason `fetch_html` gives for a download cut short by the connection failing after part of the page arrived"""
+PARSE_SECONDS_PER_CHAR = 2e-6
+"""Estimated time bs4 takes to parse a character of HTML, used to cut pages too long to parse in time"""
+CLASSIFY_BATCH_SIZE = 256
+"""Number of paragraphs the model classifies at a time, between checks of the classify budget"""
+QUANTITY_PATTERN = re.compile(r'[\d½⅓⅔¼¾⅛⅜⅝⅞]')
+"""Matches the start of a paragraph that opens with an amount, as ingredients do"""
+
+
+class Extraction(NamedTuple):
+    """
+    A recipe extracted from a webpage by `extract_recipe`
+    """
+    ingredients: List[str]
+    instructions: List[str]
+    timings: Dict[str, float]
+    """Seconds each stage of the extraction (fetch, parse, classify) took"""
+    degradations: List[str]
+    """Reasons the recipe may be incomplete, such as a stage running out of time. Empty if it is complete."""
+
+    @property
+    def complete(self) -> bool:
+        return not self.degradations
+
+
+def get_thresholds() -> Tuple[float, float]:
+    """
+    :return: the `(ingredient, instruction)` confidence thresholds saved at `THRESHOLDS_PATH` by evaluate.py, or the
+    default constants above if no calibration was saved.
+    """
+    if not os.path.exists(THRESHOLDS_PATH):
+        return CONFIDENCE_THRESHOLD_INGREDIENT, CONFIDENCE_THRESHOLD_INSTRUCTION
+    with open(THRESHOLDS_PATH) as thresholds_file:
+        thresholds = json.load(thresholds_file)
+    return thresholds['ingredient'], thresholds['instruction']
 
 
 def get_html(url: str) -> str:
@@ -21,6 +76,66 @@ def get_html(url: str) -> str:
     return requests.get(url).text
 
 
+def fetch_html(url: str, budget: float) -> Tuple[str, Optional[str]]:
+    """
+    Downloads a webpage, and stops waiting for it after `budget` seconds.
+
+    :param url: any valid URL
+    :param budget: the number of seconds to wait for the page
+    :return: A tuple of the HTML downloaded, and the reason the download was cut short (`FETCH_TIMED_OUT` or
+    `FETCH_DROPPED`), or None if the whole page was downloaded
+    :raises requests.exceptions.RequestException: if the download failed before any of the page arrived
+    """
+    if budget <= 0:
+        return '', FETCH_TIMED_OUT
+
+    chunks = []
+    encoding = []
+    errors = []
+    stop = threading.Event()
+
+    def download():
+        try:
+            with requests.get(url, stream=True, timeout=budget) as response:
+                encoding.append(response.encoding)
+                # read1 returns whatever part of the page has arrived, where read would wait for a whole chunk.
+                # Older urllib3 versions only have read.
+                read = getattr(response.raw, 'read1', response.raw.read)
+                while not stop.is_set():
+                    chunk = read(FETCH_CHUNK_SIZE, decode_content=True)
+                    if not chunk:
+                        return
+                    chunks.append(chunk)
+        except urllib3.exceptions.ReadTimeoutError as error:
+            # Reading from response.raw skips requests' wrapping of urllib3 errors, so it is done here, as in
+            # requests' iter_content.
+            errors.append(requests.exceptions.ReadTimeout(error))
+        except urllib3.exceptions.HTTPError as error:  # e.g. the connection closing before the whole page was sent
+            errors.append(requests.exceptions.ConnectionError(error))
+        except (requests.exceptions.RequestException, ValueError) as error:  # e.g. urllib3 rejecting a timeout
+            errors.append(error)
+
+    # requests timeouts only bound each socket operation, so a server sending the page slowly could keep a
+    # download going for much longer. Downloading on a daemon thread lets us stop waiting exactly on time.
+    thread = threading.Thread(target=download, daemon=True)
+    thread.start()
+    thread.join(budget)
+    stop.set()
+    content = b''.join(list(chunks))
+    truncation = None
+    if thread.is_alive() or (errors and isinstance(errors[0], requests.exceptions.Timeout)):
+        truncation = FETCH_TIMED_OUT
+    elif errors:
+        if not content:
+            raise errors[0]
+        truncation = FETCH_DROPPED
+
+    try:
+        return content.decode(encoding[0] or 'utf-8', errors='replace'), truncation
+    except (IndexError, LookupError):  # No response, or an unknown encoding
+        return content.decode('utf-8', errors='replace'), truncation
+
+
 def get_paragraphs(html_page: str) -> List[str]:
     """
     get_paragraphs(html_page: str) -> str
@@ -40,37 +155,173 @@ def get_paragraphs(html_page: str) -> List[str]:
     return clean_paragraphs(soup.find_all(text=True))
 
 
+@functools.lru_cache(maxsize=1)
+def _get_classifier() -> Tuple[classifier.Sequential, classifier.Tokenizer]:
+    """
+    :return: the classifier model and its tokenizer, loaded once and reused between classifications
+    """
+    return classifier.get_model(), classifier.get_tokenizer()
+
+
+_classifier_lock = threading.Lock()
+"""Held while loading the classifier, so that extractions running at once load it only once"""
+
+
+def warm_up():
+    """
+    Loads the classifier model ahead of time. A worker serving extractions should call this once at startup: the
+    first extraction in a process otherwise spends its classify budget loading the model, and classifies every
+    paragraph heuristically. Time spent here is not part of any extraction's deadline.
+    """
+    with _classifier_lock:
+        _get_classifier()
+
+
+def _common_phrase_class(paragraph: str) -> Optional[int]:
+    """
+    :param paragraph: a paragraph from a recipe page
+    :return: the classification of the paragraph if it is a common phrase, or None otherwise
+    """
+    if paragraph.startswith('Step ') and len(paragraph) == 6:
+        return 1
+    if paragraph.startswith('(function() {'):
+        return 2
+    return None
+
+
+def heuristic_classify(paragraph: str) -> int:
+    """
+    A cheap classification for paragraphs there was no time to run the model on: ingredients are short and start with
+    an amount, and instructions are full sentences.
+
+    :param paragraph: a paragraph from a recipe page
+    :return: integer classification of the paragraph as ingredient (0), instruction (1) or neither (2)
+    """
+    common_phrase_class = _common_phrase_class(paragraph)
+    if common_phrase_class is not None:
+        return common_phrase_class
+    words = paragraph.split()
+    if QUANTITY_PATTERN.match(paragraph) and len(words) <= 12:
+        return 0
+    if len(words) >= 6 and paragraph.endswith('.'):
+        return 1
+    return 2
+
+
+def classify_within(paragraphs: List[str], budget: float) -> Tuple[List[int], int]:
+    """
+    Classifies paragraphs with the model, a batch at a time, until `budget` seconds have passed. The paragraphs left
+    are classified by `heuristic_classify`. If the model is not loaded yet (see `warm_up`), loading it counts against
+    the budget, and carries on in the background if the budget runs out first.
+
+    :param paragraphs: paragraphs from a recipe page
+    :param budget: the number of seconds to classify for
+    :return: A tuple of the integer classification of each paragraph as ingredient (0), instruction (1) or
+    neither (2), and the number of paragraphs the model classified
+    """
+    end = time.monotonic() + budget
+    loaded = []
+    errors = []
+
+    def load():
+        try:
+            with _classifier_lock:
+                loaded.append(_get_classifier())
+        except Exception as error:  # Raised in the caller, as if the model was loaded there
+            errors.append(error)
+
+    # Loading the model can't be interrupted, so like downloads in fetch_html it is done on a daemon thread.
+    loader = threading.Thread(target=load, daemon=True)
+    loader.start()
+    loader.join(None if math.isinf(budget) else max(budget, 0))
+    if errors:
+        raise errors[0]
+    model, tokenizer = loaded[0] if loaded else (None, None)
+    ingredient_threshold, instruction_threshold = get_thresholds()
+
+    results = []
+    while loaded and len(results) < len(paragraphs) and time.monotonic() < end:
+        batch = paragraphs[len(results):len(results) + CLASSIFY_BATCH_SIZE]
+        for classification, paragraph in zip(classifier.predict(batch, model, tokenizer), batch):
+            # Common Phrases
+            common_phrase_class = _common_phrase_class(paragraph)
+            if common_phrase_class is not None:
+                results.append(common_phrase_class)
+            # Model Classifications
+            elif classification[1] > instruction_threshold:
+                results.append(1)
+            elif classification[0] > ingredient_threshold:
+                results.append(0)
+            # Default Class
+            else:
+                results.append(2)
+
+    model_count = len(results)
+    results += [heuristic_classify(paragraph) for paragraph in paragraphs[model_count:]]
+    return results, model_count
+
+
 def classify(paragraphs: List[str]) -> List[int]:
     """
     :param paragraphs: a paragraph from a recipe page
     :return: integer classification of the paragraph as ingredient (0), instruction (1) or neither (2)
     """
-    classifications = classifier.predict(paragraphs)
+    return classify_within(paragraphs, math.inf)[0]
 
-    results = []
 
-    for classification, paragraph in zip(classifications, paragraphs):
+def extract_recipe(url: str, deadline_seconds: float = REQUEST_DEADLINE) -> Extraction:
+    """
+    Extracts the ingredients and instructions from a recipe webpage within a deadline, which is split between
+    fetching, parsing and classifying the page by `STAGE_SHARES`. A stage that runs out of time degrades the result
+    rather than failing: the page is cut short, or the paragraphs left are classified by `heuristic_classify`.
+    The deadline includes loading the model, unless it was loaded beforehand by `warm_up`.
 
-        # Common Phrases
-        if paragraph.startswith('Step ') and len(paragraph) == 6:
-            results.append(1)
-        elif paragraph.startswith('(function() {'):
-            results.append(2)
-        # Model Classifications
-        elif classification[1] > CONFIDENCE_THRESHOLD_INSTRUCTION:
-            results.append(1)
-        elif classification[0] > CONFIDENCE_THRESHOLD_INGREDIENT:
-            results.append(0)
-        # Default Class
-        else:
-            results.append(2)
+    :param url: the url where the recipe is located
+    :param deadline_seconds: the number of seconds to extract the recipe in
+    :return: The extracted recipe, with the time each stage took and the reasons it may be incomplete
+    :raises requests.exceptions.ConnectionError: if the webpage could not be retrieved
+    """
+    deadline = Deadline(deadline_seconds, STAGE_SHARES)
+    degradations = []
+
+    html, truncation = fetch_html(url, deadline.start('fetch'))
+    deadline.finish('fetch')
+    if truncation:
+        degradations.append(f'{truncation} after {len(html)} characters of the page')
 
-    return results
+    # bs4 parsing can't be interrupted, so pages too long to parse in the budget are cut beforehand.
+    max_length = int(deadline.start('parse') / PARSE_SECONDS_PER_CHAR)
+    if len(html) > max_length:
+        degradations.append(f'parse cut the page from {len(html)} to {max_length} characters')
+    paragraphs = get_paragraphs(html[:max_length])
+    deadline.finish('parse')
 
+    classifications, model_count = classify_within(paragraphs, deadline.start('classify'))
+    deadline.finish('classify')
+    if model_count < len(paragraphs):
+        degradations.append(f'classify ran out of time, {len(paragraphs) - model_count}/{len(paragraphs)} '
+                            f'paragraphs classified heuristically')
+
+    # Iterate over the paragraphs and keep them in appropriate variables
+    ingredients = []
+    instructions = []
+    for paragraph_type, paragraph in zip(classifications, paragraphs):
+        # get paragraph type - 0 if it's an ingredient, 1 if it's an instruction and 2 if it is neither
 
-def get_recipe_json(url: str) -> str:
+        # Add to appropriate variable or ignore if irrelevant
+        if paragraph_type == 2:
+            continue
+        elif paragraph_type == 1:
+            instructions.append(paragraph)
+        elif paragraph_type == 0:
+            ingredients.append(paragraph)
+
+    return Extraction(ingredients, instructions, deadline.timings, degradations)
+
+
+def get_recipe_json(url: str, deadline_seconds: float = REQUEST_DEADLINE) -> str:
     """
-    get_recipe_json(url: str) -> str
+    get_recipe_json(url: str, deadline_seconds: float) -> str
 
 
     Takes the url to a recipe webpage and extracts a matching json of ingredients list and instructions string.
@@ -93,42 +344,31 @@ def get_recipe_json(url: str) -> str:
     }
 
     :param url: the url where the recipe is located
-    :return: a JSON string containing the recipe's ingredient list and instructions
+    :param deadline_seconds: the number of seconds to extract the recipe in (see `extract_recipe`)
+    :return: a JSON string containing the recipe's ingredient list and instructions. If the deadline forced the
+    extraction to degrade, an "incomplete" member lists the reasons.
     """
-    # Extract the relevant paragraphs from the webpage.
+    # Extract the recipe from the webpage.
     # Catch ConnectionError (no internet) if it rises and if so give an appropriate message and exit
     try:
-        inputs = get_paragraphs(get_html(url))
+        extraction = extract_recipe(url, deadline_seconds)
     except requests.exceptions.ConnectionError:
         print("Could not retrieve the web page. Please make sure you are connected to the Internet.")
         return ''
-
-    # Iterate over the paragraphs and keep them in appropriate variables
-    ingredients = []
-    instructions = []
-
-    classifications = classify(inputs)
-    for paragraph_type, paragraph in zip(classifications, inputs):
-        # get paragraph type - 1 if it's an ingredient, 0 if it's an instruction and -1 if it is neither
-
-        # Add to appropriate variable or ignore if irrelevant
-        if paragraph_type == 2:
-            continue
-        elif paragraph_type == 1:
-            instructions.append(paragraph)
-        elif paragraph_type == 0:
-            ingredients.append(paragraph)
+    ingredients, instructions = extraction.ingredients, extraction.instructions
 
     # Compose JSON
-    json = '{\n'  # Opening brace
-    json += "\n\tingredients: [\n\t\t"  # ingredients member, one indentation level
-    json += ',\n\t\t'.join(ingredients)  # Ingredient list in the ingredients member, two indentations member
-    json += '\n\t]'  # Close off ingredients list (one indentation level)
-    json += '\n\n\tinstructions: "'  # Declare instructions member, two indentation levels
-    json += '\n\n\t\t'.join(instructions)
-    json += '"'  # Close instructions quotation
-    json += '\n}'  # Closing brace
-    return json
+    recipe_json = '{\n'  # Opening brace
+    recipe_json += "\n\tingredients: [\n\t\t"  # ingredients member, one indentation level
+    recipe_json += ',\n\t\t'.join(ingredients)  # Ingredient list in the ingredients member, two indentations member
+    recipe_json += '\n\t]'  # Close off ingredients list (one indentation level)
+    recipe_json += '\n\n\tinstructions: "'  # Declare instructions member, two indentation levels
+    recipe_json += '\n\n\t\t'.join(instructions)
+    recipe_json += '"'  # Close instructions quotation
+    if not extraction.complete:
+        recipe_json += '\n\n\tincomplete: "' + '; '.join(extraction.degradations) + '"'  # Degradation reasons
+    recipe_json += '\n}'  # Closing brace
+    return recipe_json
 
 
 if __name__ == '__main__':
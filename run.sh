@@ -1,6 +1,7 @@
 #!/bin/env sh
 err_file=$(mktemp)
-python3 -c "from main import get_recipe_json; print(get_recipe_json('$1'))" 2>"$err_file"
+# Each run is a new process, so the model is loaded first by warm_up. The extraction deadline starts after that.
+python3 -c "from main import warm_up, get_recipe_json; warm_up(); print(get_recipe_json('$1'))" 2>"$err_file"
 
 # Suppress warning to use command in if block directly rather than checking status later. I think it's more mess
 # than it's worth.
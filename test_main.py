@@ -0,0 +1,233 @@
+"""
+Tests for deadline-aware recipe extraction in main.py, against a local HTTP server that can serve pages slowly or not
+at all. The classifier model is replaced with a fast rule-based stand-in, so the tests measure only the deadline logic.
+"""
+import socket
+import functools
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import List
+
+import pytest
+
+import classifier
+import main
+
+INGREDIENTS = ['1 cup sugar', '2 large eggs', '1/2 teaspoon salt']
+INSTRUCTIONS = ['Mix the sugar and the eggs together in a bowl.', 'Bake for twenty minutes until golden.']
+PAGE = ('<html><head><title>Cake</title></head><body><main>'
+        + ''.join(f'<p>{paragraph}</p>' for paragraph in INGREDIENTS + INSTRUCTIONS + ['Share this recipe'])
+        + '</main></body></html>').encode()
+LONG_PAGE = PAGE.replace(b'</main>', b'<p>Leave a comment below.</p>' * 100_000 + b'</main>')
+MANY_PARAGRAPHS = [f'{i} cup flour' for i in range(100)]
+DROPPED_AFTER = 49
+MANY_PARAGRAPHS_PAGE = ('<html><body><main>' + ''.join(f'<p>{paragraph}</p>' for paragraph in MANY_PARAGRAPHS)
+                        + '</main></body></html>').encode()
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    """
+    Serves recipe pages: /page at once, /drip 20 bytes every 100ms, /long as one very long page, /many with many
+    paragraphs, /stall never responds, /dropped closes the connection partway through the page and /half stalls
+    partway through it.
+    """
+    stall_released = threading.Event()
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        if self.path == '/stall':
+            self.stall_released.wait(30)
+            return
+        body = {'/long': LONG_PAGE, '/many': MANY_PARAGRAPHS_PAGE}.get(self.path, PAGE)
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/html; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        try:
+            if self.path == '/dropped':
+                self.wfile.write(body[:DROPPED_AFTER])
+                self.close_connection = True
+            elif self.path == '/half':
+                self.wfile.write(body[:DROPPED_AFTER])
+                self.wfile.flush()
+                self.stall_released.wait(2)
+            elif self.path == '/drip':
+                for start in range(0, len(body), 20):
+                    self.wfile.write(body[start:start + 20])
+                    self.wfile.flush()
+                    time.sleep(0.1)
+            else:
+                self.wfile.write(body)
+        except (BrokenPipeError, ConnectionResetError):  # The client stopped reading when it ran out of time
+            pass
+
+
+@pytest.fixture(scope='module')
+def server_url():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StandInHandler)
+    server.daemon_threads = True
+    server.block_on_close = False
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f'http://127.0.0.1:{server.server_port}'
+    StandInHandler.stall_released.set()
+    server.shutdown()
+    server.server_close()
+
+
+def fake_scores(text: str) -> List[float]:
+    """
+    Model scores by rule: amounts are ingredients, sentences are instructions.
+    """
+    if text[0].isdigit():
+        return [0.99, 0.01]
+    if text.endswith('.'):
+        return [0.01, 0.99]
+    return [0.01, 0.01]
+
+
+@pytest.fixture(autouse=True)
+def stand_in_model(monkeypatch):
+    """
+    Replaces the model with `fake_scores`. Set `delay` on the returned object to make each batch slow.
+    """
+    model = type('StandInModel', (), {'delay': 0.0})()
+
+    def predict(texts, model_=None, tokenizer=None):
+        time.sleep(model.delay)
+        return [fake_scores(text) for text in texts]
+
+    monkeypatch.setattr(main, '_get_classifier', lambda: (None, None))
+    monkeypatch.setattr(classifier, 'predict', predict)
+    monkeypatch.setattr(main, 'get_thresholds',
+                        lambda: (main.CONFIDENCE_THRESHOLD_INGREDIENT, main.CONFIDENCE_THRESHOLD_INSTRUCTION))
+    return model
+
+
+def test_complete_page(server_url):
+    extraction = main.extract_recipe(server_url + '/page', 5)
+    assert extraction.complete
+    assert extraction.ingredients == INGREDIENTS
+    assert extraction.instructions == INSTRUCTIONS
+    assert set(extraction.timings) == {'fetch', 'parse', 'classify'}
+
+
+def test_slow_drip_page_is_truncated(server_url):
+    start = time.monotonic()
+    html, truncation = main.fetch_html(server_url + '/drip', 0.55)
+    assert time.monotonic() - start < 1
+    assert truncation == main.FETCH_TIMED_OUT
+    # Data that arrived before the budget ended is kept, even though it is less than a full chunk.
+    assert 60 <= len(html) < main.FETCH_CHUNK_SIZE
+    assert PAGE.decode().startswith(html)
+
+    extraction = main.extract_recipe(server_url + '/drip', 1)
+    assert not extraction.complete
+    assert extraction.degradations[0].startswith('fetch ran out of time')
+
+
+def test_stalled_server_returns_before_deadline(server_url):
+    start = time.monotonic()
+    extraction = main.extract_recipe(server_url + '/stall', 1)
+    assert time.monotonic() - start < 1.2
+    assert extraction.ingredients == extraction.instructions == []
+    assert extraction.degradations == ['fetch ran out of time after 0 characters of the page']
+
+
+def test_long_page_is_cut_before_parsing(server_url):
+    extraction = main.extract_recipe(server_url + '/long', 1)
+    assert any(reason.startswith('parse cut the page') for reason in extraction.degradations)
+    assert extraction.ingredients == INGREDIENTS
+    assert extraction.timings['parse'] < 1
+
+
+def test_slow_model_falls_back_to_heuristic(server_url, stand_in_model, monkeypatch):
+    monkeypatch.setattr(main, 'CLASSIFY_BATCH_SIZE', 10)
+    stand_in_model.delay = 0.2
+    classifications, model_count = main.classify_within(MANY_PARAGRAPHS, 0.5)
+    assert 0 < model_count < len(MANY_PARAGRAPHS)
+    assert classifications[model_count:] == [main.heuristic_classify(paragraph)
+                                             for paragraph in MANY_PARAGRAPHS[model_count:]]
+
+    extraction = main.extract_recipe(server_url + '/many', 1)
+    assert any(reason.startswith('classify ran out of time') for reason in extraction.degradations)
+    # The heuristic also takes short paragraphs starting with an amount as ingredients.
+    assert extraction.ingredients == MANY_PARAGRAPHS
+
+
+def test_dropped_connection_is_truncation(server_url, monkeypatch):
+    thread_errors = []
+    monkeypatch.setattr(threading, 'excepthook', thread_errors.append)
+    html, truncation = main.fetch_html(server_url + '/dropped', 1)
+    assert html == PAGE[:DROPPED_AFTER].decode()
+    assert truncation == main.FETCH_DROPPED
+
+    extraction = main.extract_recipe(server_url + '/dropped', 1)
+    assert extraction.degradations == [f'fetch lost the connection after {DROPPED_AFTER} characters of the page']
+    assert thread_errors == []
+
+
+def test_stall_partway_through_page(server_url, monkeypatch):
+    thread_errors = []
+    monkeypatch.setattr(threading, 'excepthook', thread_errors.append)
+    html, truncation = main.fetch_html(server_url + '/half', 0.3)
+    assert html == PAGE[:DROPPED_AFTER].decode()
+    assert truncation == main.FETCH_TIMED_OUT
+    time.sleep(0.5)  # Give the download thread time to hit its read timeout
+    assert thread_errors == []
+
+
+def test_model_loading_counts_against_deadline(server_url, monkeypatch):
+    loading_released = threading.Event()
+
+    def load_slowly():
+        loading_released.wait(2)
+        return None, None
+
+    monkeypatch.setattr(main, '_get_classifier', load_slowly)
+    start = time.monotonic()
+    classifications, model_count = main.classify_within(INGREDIENTS, 0.2)
+    assert time.monotonic() - start < 0.4
+    assert model_count == 0
+    assert classifications == [main.heuristic_classify(paragraph) for paragraph in INGREDIENTS]
+
+    start = time.monotonic()
+    extraction = main.extract_recipe(server_url + '/page', 1)
+    assert time.monotonic() - start < 1.2
+    assert any(reason.startswith('classify ran out of time') for reason in extraction.degradations)
+    loading_released.set()  # Let the loads still running in the background finish, so they don't hold the model lock
+
+
+def test_warm_up_loads_the_model_outside_the_deadline(monkeypatch):
+    loads = []
+
+    def load_slowly():
+        time.sleep(0.5)
+        loads.append(None)
+        return None, None
+
+    monkeypatch.setattr(main, '_get_classifier', functools.lru_cache(maxsize=1)(load_slowly))
+    main.warm_up()
+    _, model_count = main.classify_within(INGREDIENTS, 0.2)
+    assert model_count == len(INGREDIENTS)
+    assert len(loads) == 1
+
+
+def test_expired_deadline_skips_fetch(server_url, monkeypatch):
+    thread_errors = []
+    monkeypatch.setattr(threading, 'excepthook', thread_errors.append)
+    extraction = main.extract_recipe(server_url + '/page', 0)
+    assert extraction.degradations == ['fetch ran out of time after 0 characters of the page']
+    assert main.fetch_html(server_url + '/page', -1) == ('', main.FETCH_TIMED_OUT)
+    time.sleep(0.1)  # Give a download thread, had one started, time to fail
+    assert thread_errors == []
+
+
+def test_refused_connection(capsys):
+    with socket.socket() as unused:
+        unused.bind(('127.0.0.1', 0))
+        port = unused.getsockname()[1]
+    assert main.get_recipe_json(f'http://127.0.0.1:{port}/', 1) == ''
+    assert 'Could not retrieve the web page' in capsys.readouterr().out
@@ -1,12 +1,19 @@
+import os
+import time
+import shutil
+import hashlib
+import itertools
 import tensorflow as tf
 import numpy as np
-from typing import Type, List, Any
+from typing import Type, List, Any, Tuple, Dict
 from bs4 import element
 from tensorflow.keras.preprocessing.text import Tokenizer
 from tensorflow.keras.preprocessing.sequence import pad_sequences
 
 DATAFILES = ['datafiles/' + filename for filename in ['ingredients.txt', 'instructions.txt', 'neither.txt']]
 OOV_TOKEN = '<OOV>'
+HASH_CHUNK_SIZE = 2 ** 20
+"""Number of bytes `fingerprint` reads from a file at a time"""
 
 
 class ModelSaver(tf.keras.callbacks.Callback):
@@ -23,6 +30,37 @@ class ModelSaver(tf.keras.callbacks.Callback):
             self.model.stop_training = True
 
 
+class Deadline:
+    """
+    A time limit for a task done in consecutive stages. Each stage gets a budget out of the time that is left, in
+    proportion to its share; time a stage does not use is split between the stages after it.
+    """
+    def __init__(self, seconds: float, shares: Dict[str, float]):
+        self.end = time.monotonic() + seconds
+        self.shares = dict(shares)
+        self.timings = {}
+        self._stage_start = None
+
+    def remaining(self) -> float:
+        return max(0.0, self.end - time.monotonic())
+
+    def start(self, stage: str) -> float:
+        """
+        :param stage: the name of the stage to start, as in the shares the deadline was created with
+        :return: the number of seconds the stage has
+        """
+        pending_shares = sum(share for name, share in self.shares.items() if name not in self.timings)
+        self._stage_start = time.monotonic()
+        return self.remaining() * self.shares[stage] / pending_shares
+
+    def finish(self, stage: str):
+        """
+        Records how long a stage took, in `timings`
+        :param stage: the name of the stage that was started last
+        """
+        self.timings[stage] = time.monotonic() - self._stage_start
+
+
 def generate_tokenizer(voc_size: int, texts_to_fit: List[str], save_path: str) -> Tokenizer:
     tokenizer = Tokenizer(num_words=voc_size, oov_token=OOV_TOKEN)
     tokenizer.fit_on_texts(texts_to_fit)
@@ -50,6 +88,89 @@ def preprocess_text(raw_data: List[str], tokenizer: Tokenizer, max_length: int)
     return np.array(padded)
 
 
+def write_shard(sequences: List[List[int]], labels: List[List[int]], directory: str):
+    """
+    Writes tokenized data to disk in a compact format: the token IDs of all sequences concatenated into a single
+    uint16 array, an offsets array marking where each sequence starts and ends, and a uint8 labels array.
+    The shard is written to a temporary directory first and then moved into place, so a partially written shard is
+    never loaded.
+
+    :param sequences: tokenized sequences, as returned by a tokenizer's texts_to_sequences
+    :param labels: a 2d list of integer labels matching the sequences
+    :param directory: the directory to write the shard's arrays to
+    """
+    lengths = np.fromiter(map(len, sequences), dtype=np.int64, count=len(sequences))
+    offsets = np.zeros(len(sequences) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    tokens = np.fromiter(itertools.chain.from_iterable(sequences), dtype=np.uint16, count=offsets[-1])
+
+    temp_directory = directory + '.tmp'
+    shutil.rmtree(temp_directory, ignore_errors=True)
+    os.makedirs(temp_directory)
+    np.save(os.path.join(temp_directory, 'tokens.npy'), tokens)
+    np.save(os.path.join(temp_directory, 'offsets.npy'), offsets)
+    np.save(os.path.join(temp_directory, 'labels.npy'), np.array(labels, dtype=np.uint8))
+    os.rename(temp_directory, directory)
+
+
+def load_shard(directory: str) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Loads a shard written by `write_shard`. The arrays are memory-mapped rather than read, so loading is
+    near-instant and pages are only read from disk when batches use them.
+
+    :param directory: the directory the shard was written to
+    :return: A tuple of the flat token array, the offsets array and the labels array
+    """
+    return tuple(np.load(os.path.join(directory, name + '.npy'), mmap_mode='r')
+                 for name in ['tokens', 'offsets', 'labels'])
+
+
+def pad_batch(tokens: np.ndarray, offsets: np.ndarray, indices: np.ndarray, max_length: int) -> np.ndarray:
+    """
+    Builds model input for some of the sequences in a shard. Padding and truncation match `preprocess_text`: both
+    are done at the start of the sequence.
+
+    :param tokens: the shard's flat token array
+    :param offsets: the shard's offsets array
+    :param indices: indices of the sequences to include
+    :param max_length: the maximum length (in words) of a given input to the model
+    :return: A (len(indices), max_length) int32 array, each row being a valid model input
+    """
+    batch = np.zeros((len(indices), max_length), dtype=np.int32)
+    for row, index in enumerate(indices):
+        start, end = offsets[index], offsets[index + 1]
+        sequence = tokens[max(start, end - max_length):end]
+        batch[row, max_length - len(sequence):] = sequence
+    return batch
+
+
+class ShardSequence(tf.keras.utils.Sequence):
+    """
+    Feeds a keras model batches from a shard written by `write_shard`, padding each batch as it is requested
+    rather than holding the whole padded dataset in memory.
+    """
+    def __init__(self, shard: Tuple[np.ndarray, np.ndarray, np.ndarray], indices: np.ndarray, max_length: int,
+                 batch_size: int = 32, shuffle: bool = False):
+        super().__init__()
+        self.tokens, self.offsets, self.labels = shard
+        self.indices = np.array(indices)
+        self.max_length = max_length
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.on_epoch_end()
+
+    def __len__(self):
+        return (len(self.indices) + self.batch_size - 1) // self.batch_size
+
+    def __getitem__(self, batch_index):
+        indices = self.indices[batch_index * self.batch_size:(batch_index + 1) * self.batch_size]
+        return pad_batch(self.tokens, self.offsets, indices, self.max_length), np.asarray(self.labels[indices])
+
+    def on_epoch_end(self):
+        if self.shuffle:
+            np.random.shuffle(self.indices)
+
+
 def preprocess_labels(labels: List[List[int]]) -> np.array:
     """
     Does preprocessing for list labels. Really it just converts them to arrays, but it exists for order for order
@@ -60,6 +181,30 @@ def preprocess_labels(labels: List[List[int]]) -> np.array:
     return np.array(labels)
 
 
+def fingerprint(*paths: str) -> str:
+    """
+    Hashes the contents of files (and of every file under directories) into a single short digest, used to tell
+    whether data cached from a model or tokenizer is still up to date. Files are read `HASH_CHUNK_SIZE` bytes at a
+    time, and each file's path and size are hashed before its contents, so content moving between files changes the
+    digest too.
+
+    :param paths: paths of files or directories to hash
+    :return: a hex digest that changes whenever any of the hashed files does
+    """
+    digest = hashlib.sha1()
+    for path in paths:
+        if os.path.isdir(path):
+            files = sorted(os.path.join(root, name) for root, _, names in os.walk(path) for name in names)
+        else:
+            files = [path]
+        for filename in files:
+            digest.update(f'{filename}\0{os.path.getsize(filename)}\0'.encode())
+            with open(filename, 'rb') as file:
+                for chunk in iter(lambda: file.read(HASH_CHUNK_SIZE), b''):
+                    digest.update(chunk)
+    return digest.hexdigest()[:16]
+
+
 def _blacklist_filter(line: Any) -> bool:
     """
     A predicate used to filter out irrelevant lines often found in ingredient and instructions